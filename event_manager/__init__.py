@@ -52,7 +52,12 @@ def cli():
 @click.option("-a", is_flag=True, help="auto refresh when config is updated")
 @click.option("-e", is_flag=True, help="delete files after finishing jobs")
 @click.option("-v", is_flag=True, help="debug mode")
-def start(d, f, l, c, r, a, e, v):
+@click.option(
+    "-m",
+    is_flag=True,
+    help="with -r, watch the tree with one fanotify mark (Linux 5.9+, CAP_SYS_ADMIN)",
+)
+def start(d, f, l, c, r, a, e, v, m):
     """start event-manager"""
     event_manager.EventManager(
         event_manager.GeneralConfig(
@@ -64,6 +69,7 @@ def start(d, f, l, c, r, a, e, v):
             refresh=a,
             delete=e,
             debug=v,
+            fanotify=m,
         )
     ).run()
 
@@ -22,8 +22,10 @@ class DefaultSortedDict(sortedcontainers.SortedDict):
 class crule:
     def __init__(self, frequency):
         minute, hour, day, month, weekday = frequency.split()
+        self.last = datetime.datetime.now()
         self.rrule = dateutil.rrule.rrule(
             dateutil.rrule.DAILY,
+            dtstart=self.last,
             bymonth=map(int, month.split(",")),
             bymonthday=map(int, day.split(",")),
             byweekday=map(int, weekday.split(",")),
@@ -33,9 +35,21 @@ class crule:
         )
 
     def get_next_time(self):
-        for rule in self.rrule:
-            if rule > datetime.datetime.now():
-                yield rule
+        # Start the rule from the last returned time so after() skips the past
+        # occurrences instead of iterating them, and never repeats a time.
+        self.last = self.rrule.after(max(datetime.datetime.now(), self.last))
+        if self.last:
+            self.rrule = self.rrule.replace(dtstart=self.last)
+        return self.last
+
+
+async def sleep_until(at):
+    # Wait on the monotonic loop clock, in slices so long waits stay cancellable.
+    loop = asyncio.get_running_loop()
+    delay = max(0.0, (at - datetime.datetime.now()).total_seconds())
+    deadline = loop.time() + delay
+    while (remain := deadline - loop.time()) > 0:
+        await asyncio.sleep(min(remain, 60))
 
 
 class crontab:
@@ -43,18 +57,22 @@ class crontab:
         self.rules = DefaultSortedDict()
 
     def add_rule(self, frequency, name):
-        rule = crule(frequency)
-        self.rules[rule.get_next_time()].append((rule, name))
+        self.schedule(crule(frequency), name)
+
+    def schedule(self, rule, name):
+        at = rule.get_next_time()
+        if at:
+            self.rules[at].append((rule, name))
 
     async def generate(self):
         while True:
             if self.rules:
                 at, rule_list = self.rules.popitem(0)
-                await asyncio.sleep(at - datetime.datetime.now())
+                await sleep_until(at)
 
                 for rule, name in rule_list:
                     yield at, name
-                    self.rules[rule.get_next_time()].append((rule, name))
+                    self.schedule(rule, name)
 
             else:
                 await asyncio.sleep(60)
@@ -9,22 +9,49 @@ Watch filesystem using inotify, react and monitor subprocess when event is gener
 """
 
 import asyncio
+import collections
 import dataclasses
+import errno
+import functools
+import logging
+import os
 import os.path
 import pathlib
 import re
 import shutil
+import signal
 import string
 
-import psutil
 import yaml
 
 from . import cron, file_watch, log
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+_YAML_CACHE: collections.OrderedDict[pathlib.Path, tuple[int, int, dict]] = (
+    collections.OrderedDict()
+)
+_YAML_CACHE_MAX = 32
+_REGEX_META = re.compile(r"[\[\](){}*+?|^$\\]")
+_REGEX_GROUP_REF = re.compile(r"\\\d|\(\?P=|\(\?\(")
+_COPY_BLOCKSIZE = 1 << 20
+_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+@functools.lru_cache(maxsize=1024)
 def resolve_path_all(path: pathlib.Path, resolve: bool = True) -> pathlib.Path:
     """ Expend environment variables and resolve path.
 
+    Results are cached, triggers of a config share the same few prefixes.
+
     Args:
         path (pathlib.Path): [description]
         resolve (bool, optional): [description]. Defaults to True.
@@ -39,6 +66,123 @@ def resolve_path_all(path: pathlib.Path, resolve: bool = True) -> pathlib.Path:
     return path
 
 
+def _load_yaml_cached(path: pathlib.Path) -> dict:
+    """ Load a yaml file, reusing the previous parse if the file is unchanged.
+
+    Entries are validated by mtime and size and bounded in LRU order.
+    The returned dict is shared with the cache, treat it as read-only.
+
+    Args:
+        path (pathlib.Path): resolved path of the yaml file
+
+    Returns:
+        dict: parsed yaml content
+    """
+    stat = path.stat()
+    cached = _YAML_CACHE.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        _YAML_CACHE.move_to_end(path)
+        return cached[2]
+
+    content = yaml.load(path.read_text(), Loader=_SafeLoader)
+    _YAML_CACHE[path] = (stat.st_mtime_ns, stat.st_size, content)
+    _YAML_CACHE.move_to_end(path)
+    if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+        _YAML_CACHE.popitem(last=False)
+    return content
+
+
+def combine_patterns(triggers: list) -> re.Pattern:
+    """ Compile patterns of triggers into one alternation to test them in one pass.
+
+    Each pattern is wrapped in a group named by its index, so the name of the
+    last matched group is the first matching trigger.
+
+    Args:
+        triggers (list): triggers sharing the same parent directory
+
+    Returns:
+        re.Pattern: combined pattern, None if not worth or unable to combine
+    """
+    if len(triggers) < 2 or any(
+        _REGEX_GROUP_REF.search(trigger.pattern.pattern) for trigger in triggers
+    ):
+        return None
+
+    try:
+        return re.compile(
+            "|".join(
+                f"(?P<t{i}>{trigger.pattern.pattern})"
+                for i, trigger in enumerate(triggers)
+            )
+        )
+    except re.error:
+        # e.g. the same group name used by several triggers
+        return None
+
+
+def _fast_copy(src: str, dst: pathlib.Path):
+    """ Copy file content inside the kernel and keep its permission bits.
+
+    Use copy_file_range, then sendfile when the former is unsupported
+    (e.g. across filesystems on old kernels), then shutil.copyfile.
+
+    Args:
+        src (str): source file
+        dst (pathlib.Path): destination file, truncated if exists
+
+    Raises:
+        shutil.SameFileError: dst is src, e.g. through a symlink
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        stat = os.fstat(src_fd)
+        try:
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            pass
+        else:
+            # as shutil.copyfile, O_TRUNC would empty the source otherwise
+            if (dst_stat.st_dev, dst_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+        mode = stat.st_mode & 0o777
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            os.fchmod(dst_fd, mode)
+            blocksize = max(stat.st_size, _COPY_BLOCKSIZE)
+            # both calls move the file offsets, so a fallback resumes the copy
+            for copy in (
+                lambda: os.copy_file_range(src_fd, dst_fd, blocksize),
+                lambda: os.sendfile(dst_fd, src_fd, None, blocksize),
+            ):
+                try:
+                    while copy():
+                        pass
+                    return
+                except OSError as err:
+                    if err.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    shutil.copyfile(src, dst)
+
+
+def _kill_group(pid: int, signum: int):
+    """ Signal the process group of a worker process, if it is still there.
+
+    Args:
+        pid (int): pid of the session leader started by a worker
+        signum (int): signal to send
+    """
+    try:
+        os.killpg(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
 class GroupTemplate(string.Template):
     """ Overwrite idpattern to enable $1 $2 ...
 
@@ -49,7 +193,7 @@ class GroupTemplate(string.Template):
     idpattern = r"\w+"
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class GeneralConfig:
     """Global config"""
 
@@ -61,6 +205,7 @@ class GeneralConfig:
     refresh: bool = False
     delete: bool = False
     debug: bool = False
+    fanotify: bool = False
 
     def __post_init__(self):
         self.watch = resolve_path_all(self.watch)
@@ -68,28 +213,34 @@ class GeneralConfig:
         self.log = log.get_logger(resolve_path_all(self.log), self.debug)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class TriggerItem:
     """
     Instances of file triggers. The relationship to event is many to one.
 
     Pattern is precompiled from file name to save match time.
+    Index is the position in the config, matches are reported in that order.
     """
 
     file: str
     event: str
     watch: dataclasses.InitVar[pathlib.Path]
     backup: str = None
+    index: int = None
     pattern: re.Pattern = None
+    pos_keys: tuple = None
+    backup_template: GroupTemplate = None
 
     def __post_init__(self, watch):
         self.file = (watch / resolve_path_all(self.file, False)).resolve()
         self.pattern = re.compile(str(self.file))
+        self.pos_keys = tuple(str(i) for i in range(1, self.pattern.groups + 1))
         if self.backup:
             self.backup = (watch / resolve_path_all(self.backup, False)).resolve()
+            self.backup_template = GroupTemplate(str(self.backup))
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class EventItem:
     """Instances of events"""
 
@@ -107,30 +258,64 @@ class EventItem:
         if self.mapping:
             self.sub = self.process.safe_substitute(**self.mapping)
 
+    def clone_with_mapping(self, mapping: dict) -> "EventItem":
+        """ Copy the event with a new mapping without running __post_init__ again.
+
+        Args:
+            mapping (dict): values to substitute into process
+
+        Returns:
+            EventItem: event ready to be queued
+        """
+        new = EventItem.__new__(EventItem)
+        new.process = self.process
+        new.timeout = self.timeout
+        new.success = self.success
+        new.fail = self.fail
+        new.mapping = mapping
+        new.sub = self.process.safe_substitute(**mapping) if mapping else self.sub
+        return new
+
 
 class EventManager:
     """This is the core of event manager."""
 
     def __init__(self, config):
         self.config = config
+        self._debug_enabled = False
+        self._conf_path = None
         self.triggers = None
+        self._triggers_by_parent = None
+        self._bucket_regex = None
+        self._wild_triggers = None
+        self._wild_regex = None
         self.events = None
+        self._backup_dirs = set()
         self.filewatcher = file_watch.FileWatcher()
         self.crontab = cron.crontab()
-        self.queue = asyncio.Queue()
+        self._pending = collections.deque()
+        self._has_work = asyncio.Event()
+        if uvloop:
+            asyncio.set_event_loop(uvloop.new_event_loop())
         self.event_loop = asyncio.get_event_loop()
+        self._tasks = None
         self.load_config()
 
     def load_config(self):
         """Load the yaml config and do initial settings."""
-        yml_conf = yaml.safe_load(self.config.conf.read_text())
+        yml_conf = _load_yaml_cached(self.config.conf)
         if "General" in yml_conf:
             self.config = dataclasses.replace(
                 self.config,
                 **yml_conf["General"],
             )
+        self._debug_enabled = self.config.log.isEnabledFor(logging.DEBUG)
+        self._conf_path = str(self.config.conf)
         self.triggers = []
+        self._triggers_by_parent = collections.defaultdict(list)
+        self._wild_triggers = []
         self.events = {}
+        watch_dirs = set()
 
         for name, item in yml_conf["Events"].items():
             if "Process" in item:
@@ -147,27 +332,44 @@ class EventManager:
                         event=name,
                         backup=item.get("Backup"),
                         watch=self.config.watch,
+                        index=len(self.triggers),
                     )
                     self.triggers.append(trigger)
 
+                    if _REGEX_META.search(str(trigger.file.parent)):
+                        self._wild_triggers.append(trigger)
+                    else:
+                        parent = str(trigger.file.parent)
+                        self._triggers_by_parent[parent].append(trigger)
+
                     if not self.config.recursive and trigger.file.parent.is_dir():
-                        self.filewatcher.add_watch(trigger.file.parent)
+                        watch_dirs.add(trigger.file.parent)
 
                 elif "Cron" in item:
                     self.crontab.add_rule(item["Cron"], name)
 
-        if self.config.recursive:
-            self.filewatcher.rec_add_watch(self.config.watch)
+        self._bucket_regex = {
+            parent: combine_patterns(triggers)
+            for parent, triggers in self._triggers_by_parent.items()
+        }
+        self._wild_regex = combine_patterns(self._wild_triggers)
 
-        if not self.filewatcher.watch_dir:
-            raise Exception("No vaild triggers, exit.")
-
-        if self.config.refresh:
-            self.filewatcher.add_watch(self.config.conf.parent)
+        if self.config.recursive:
+            self.filewatcher.rec_add_watch(self.config.watch, self.config.fanotify)
+            if self.config.refresh:
+                self.filewatcher.add_watch(self.config.conf.parent)
+        else:
+            if not watch_dirs:
+                raise Exception("No vaild triggers, exit.")
+            if self.config.refresh:
+                watch_dirs.add(self.config.conf.parent)
+            # Reloads keep the unchanged watches instead of recreating inotify.
+            self.filewatcher.rewatch(watch_dirs)
 
         self.config.log.info(
             "%s eventmanager start %s\nwatch: %s\nconf: %s\nlog: %s\nconcurrent: %s\n"
-            "recursive: %s\nauto_refresh: %s\ndelete_file: %s\ndebug: %s",
+            "recursive: %s\nauto_refresh: %s\ndelete_file: %s\ndebug: %s\n"
+            "fanotify: %s",
             "-" * 30,
             "-" * 30,
             *dataclasses.astuple(self.config),
@@ -175,110 +377,209 @@ class EventManager:
 
     def run(self):
         """Run the event loop."""
-        self.event_loop.add_reader(self.filewatcher.inotify.fd, self.read_inotify_event)
-        self.event_loop.run_until_complete(
-            asyncio.gather(
-                *[self.worker() for _ in range(self.config.concurrent)],
-                self.read_cron_event(),
-            )
+        self.event_loop.add_reader(self.filewatcher.fileno(), self.read_inotify_event)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.event_loop.add_signal_handler(signum, self.filewatcher.stop)
+
+        self._tasks = asyncio.gather(
+            *[self.worker() for _ in range(self.config.concurrent)],
+            self.read_cron_event(),
         )
+        try:
+            self.event_loop.run_until_complete(self._tasks)
+        except asyncio.CancelledError:
+            self.config.log.info("eventmanager stop")
+        finally:
+            self.event_loop.remove_reader(self.filewatcher.fileno())
+            self.filewatcher.close()
+
+    def candidate_buckets(self, pathname: str):
+        """ Yield triggers which may match the file with their combined pattern.
+
+        Triggers whose parent directory is literal can only match files below it,
+        so they are looked up by the ancestors of the file instead of scanned.
+
+        Args:
+            pathname (str): absolute path of the detected file
+        """
+        end = len(pathname)
+        while (end := pathname.rfind("/", 0, end)) >= 0:
+            parent = pathname[:end] or "/"
+            triggers = self._triggers_by_parent.get(parent)
+            if triggers:
+                yield triggers, self._bucket_regex[parent]
+        yield self._wild_triggers, self._wild_regex
+
+    def match_triggers(self, pathname: str) -> list:
+        """ Find every trigger matching the file along with its match object.
+
+        Args:
+            pathname (str): absolute path of the detected file
+
+        Returns:
+            list: (trigger, match) pairs in the order of the config
+        """
+        hits = []
+        for triggers, combined in self.candidate_buckets(pathname):
+            start = 0
+            if combined:
+                hit = combined.match(pathname)
+                if not hit:
+                    continue
+                start = int(hit.lastgroup[1:])
+
+            for trigger in triggers[start:]:
+                match = trigger.pattern.match(pathname)
+                if match:
+                    hits.append((trigger, match))
+
+        # buckets are visited deepest ancestor first, then the wildcard one
+        if len(hits) > 1:
+            hits.sort(key=lambda hit: hit[0].index)
+        return hits
 
     def read_inotify_event(self):
-        """Handle inotify events."""
-        for status, pathname in self.filewatcher.read():
-            if self.config.refresh and pathname.samefile(self.config.conf):
-                if not self.config.recursive:
-                    self.event_loop.remove_reader(self.filewatcher.inotify.fd)
-                    self.filewatcher.reset()
-                    self.event_loop.add_reader(
-                        self.filewatcher.inotify.fd, self.read_inotify_event
-                    )
-
-                self.crontab.clear_all_rules()
-                self.load_config()
-
-            elif status == "mkdir":
-                self.filewatcher.add_watch(pathname, rec_flag=True)
-                self.config.log.debug("add %s to watch", str(pathname))
-
-            elif status == "rmdir":
-                self.filewatcher.remove_watch(pathname)
-                self.config.log.debug("remove %s from watch", str(pathname))
-
-            elif status == "file":
-                self.config.log.debug("detected file %s", str(pathname))
-
-                for trigger in self.triggers:
-                    match = trigger.pattern.match(str(pathname))
-                    if match:
-                        mapping = {
-                            **match.groupdict(),
-                            **{str(i): j for i, j in enumerate(match.groups(), 1)},
-                            "file": pathname,
-                        }
-
-                        self.queue.put_nowait(
-                            dataclasses.replace(
-                                self.events[trigger.event],
-                                mapping=mapping,
-                            )
-                        )
-
-                        if trigger.backup:
-                            backup = GroupTemplate(str(trigger.backup)).safe_substitute(
-                                **mapping
-                            )
-                            pathlib.Path(backup).parent.mkdir(
-                                parents=True, exist_ok=True
-                            )
-                            shutil.copyfile(pathname, backup)
-                            self.config.log.info("backup file to %s", backup)
-
-                if self.config.delete and pathname.is_file():
-                    pathname.unlink()
-                    self.config.log.info("remove file %s", str(pathname))
+        """Handle the inotify events read since the last call."""
+        readable = self.filewatcher.wait(0)
+        if self.filewatcher.stopped:
+            self._tasks.cancel()
+            return
+        if not readable:
+            return
+
+        for status, pathname in self.filewatcher.drain():
+            self._dispatch(status, pathname)
+
+    def _dispatch(self, status: str, pathname: str):
+        """ React to one event read from the file watcher.
+
+        Args:
+            status (str): kind of the event, see FileWatcher.drain
+            pathname (str): path the event happened on
+        """
+        # Watched directories are resolved, compare paths instead of stat both.
+        if self.config.refresh and pathname == self._conf_path:
+            self.crontab.clear_all_rules()
+            self.load_config()
+
+        elif status == "mkdir":
+            self.filewatcher.add_watch(pathlib.Path(pathname), rec_flag=True)
+            if self._debug_enabled:
+                self.config.log.debug("add %s to watch", pathname)
+
+        elif status == "rmdir":
+            self.filewatcher.remove_watch(pathlib.Path(pathname))
+            if self._debug_enabled:
+                self.config.log.debug("remove %s from watch", pathname)
+
+        elif status == "file":
+            if self._debug_enabled:
+                self.config.log.debug("detected file %s", pathname)
+
+            for trigger, match in self.match_triggers(pathname):
+                mapping = match.groupdict()
+                mapping.update(zip(trigger.pos_keys, match.groups()))
+                mapping["file"] = pathname
+
+                self.enqueue(self.events[trigger.event].clone_with_mapping(mapping))
+
+                if trigger.backup:
+                    backup = trigger.backup_template.safe_substitute(**mapping)
+                    self.copy_backup(pathname, pathlib.Path(backup))
+                    self.config.log.info("backup file to %s", backup)
+
+            if self.config.delete:
+                try:
+                    os.unlink(pathname)
+                except FileNotFoundError:
+                    pass
+                else:
+                    self.config.log.info("remove file %s", pathname)
+
+    def copy_backup(self, pathname: str, backup: pathlib.Path):
+        """ Copy the file to backup, creating each backup directory only once.
+
+        Args:
+            pathname (str): file to backup
+            backup (pathlib.Path): destination of the copy
+        """
+        if backup.parent not in self._backup_dirs:
+            backup.parent.mkdir(parents=True, exist_ok=True)
+            self._backup_dirs.add(backup.parent)
+
+        try:
+            _fast_copy(pathname, backup)
+        except FileNotFoundError:
+            # backup directory removed since it was created
+            backup.parent.mkdir(parents=True, exist_ok=True)
+            _fast_copy(pathname, backup)
 
     async def read_cron_event(self):
         async for at, name in self.crontab.generate():
-            self.queue.put_nowait(
-                dataclasses.replace(
-                    self.events[name],
-                    mapping={
-                        year: at.year,
-                        month: at.month,
-                        day: at.day,
-                        hour: at.hour,
-                        minute: at.minute,
-                    },
+            self.enqueue(
+                self.events[name].clone_with_mapping(
+                    {
+                        "year": at.year,
+                        "month": at.month,
+                        "day": at.day,
+                        "hour": at.hour,
+                        "minute": at.minute,
+                    }
                 )
             )
 
+    def enqueue(self, event: EventItem):
+        """ Put the event into the queue and wake up idle workers.
+
+        Args:
+            event (EventItem): event to run
+        """
+        self._pending.append(event)
+        self._has_work.set()
+
+    async def dequeue(self) -> EventItem:
+        """ Wait until the queue is not empty and take the first event.
+
+        Returns:
+            EventItem: event to run
+        """
+        while not self._pending:
+            self._has_work.clear()
+            await self._has_work.wait()
+        return self._pending.popleft()
+
     async def worker(self):
         """Monitor Processes and put next events into the queue after finished."""
         while True:
-            event = await self.queue.get()
-            process = await asyncio.create_subprocess_shell(event.sub)
-            self.config.log.debug("Start: %s\nPid: %s", event.sub, process.pid)
+            event = await self.dequeue()
+            # own session, so a timeout can kill the whole process tree at once
+            process = await asyncio.create_subprocess_shell(
+                event.sub, start_new_session=True
+            )
+            if self._debug_enabled:
+                self.config.log.debug("Start: %s\nPid: %s", event.sub, process.pid)
 
+            next_event = None
             try:
                 await asyncio.wait_for(process.wait(), event.timeout)
 
             except asyncio.TimeoutError:
-                for child in psutil.Process(process.pid).children(True):
-                    child.kill()
-                process.kill()
+                _kill_group(process.pid, signal.SIGKILL)
                 stats = "Timeout"
 
+            except asyncio.CancelledError:
+                # stopping, Ctrl-C does not reach the own session of the process
+                _kill_group(process.pid, signal.SIGTERM)
+                self.config.log.info("Stop: %s\nPid: %s", event.sub, process.pid)
+                raise
+
             else:
                 stats = "fail" if process.returncode else "success"
                 next_event = getattr(event, stats)
 
                 if next_event:
-                    self.queue.put_nowait(
-                        dataclasses.replace(
-                            self.events[next_event],
-                            mapping=event.mapping,
-                        )
+                    self.enqueue(
+                        self.events[next_event].clone_with_mapping(event.mapping)
                     )
 
             self.config.log.info(
@@ -6,52 +6,463 @@ Filename: filewatcher
 Author: CJ Lin
 """
 
+import ctypes
+import functools
+import logging
+import os
 import pathlib
+import re
+import select
+import struct
 
 from inotify_simple import INotify, flags
 
-MASK_DIR = flags.CLOSE_WRITE | flags.MOVED_TO
-MASK_REC = MASK_DIR | flags.ISDIR | flags.CREATE | flags.DELETE | flags.MOVED_FROM
+MASK_DIR = int(flags.CLOSE_WRITE | flags.MOVED_TO)
+MASK_REC = int(MASK_DIR | flags.ISDIR | flags.CREATE | flags.DELETE | flags.MOVED_FROM)
+_ISDIR = int(flags.ISDIR)
+_CREATE = int(flags.CREATE)
+_MOVED_TO = int(flags.MOVED_TO)
+_CLOSE_WRITE = int(flags.CLOSE_WRITE)
+_Q_OVERFLOW = int(flags.Q_OVERFLOW)
+_IGNORED = int(flags.IGNORED)
+# struct inotify_event without the trailing name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+READ_BUFFER_SIZE = 1 << 16
+# edge-triggered, every wakeup has to drain() the fd until EAGAIN
+INOTIFY_EPOLL_MASK = select.EPOLLIN | select.EPOLLET
+
+# editors and tools keep writing the same few names, e.g. swap or temp files
+_decode_name = functools.lru_cache(maxsize=1024)(os.fsdecode)
+
+_log = logging.getLogger(__name__)
+
+# fanotify with a filesystem mark covers a whole tree with one mark, instead of
+# one inotify watch per directory. It needs Linux 5.9+ and CAP_SYS_ADMIN.
+_libc = ctypes.CDLL(None, use_errno=True)
+HAS_FANOTIFY = hasattr(_libc, "fanotify_init") and hasattr(_libc, "open_by_handle_at")
+if HAS_FANOTIFY:
+    _libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+    _libc.fanotify_mark.argtypes = [
+        ctypes.c_int,
+        ctypes.c_uint,
+        ctypes.c_uint64,
+        ctypes.c_int,
+        ctypes.c_char_p,
+    ]
+    _libc.name_to_handle_at.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.c_int,
+    ]
+    _libc.open_by_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+
+FAN_INIT_FLAGS = 0x1 | 0x2 | 0xC00  # FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DFID_NAME
+FAN_MARK_FLAGS = 0x1 | 0x100  # FAN_MARK_ADD | FAN_MARK_FILESYSTEM
+_FAN_CLOSE_WRITE = 0x8
+_FAN_MOVED_FROM = 0x40
+_FAN_MOVED_TO = 0x80
+_FAN_DELETE = 0x200
+_FAN_Q_OVERFLOW = 0x4000
+_FAN_ONDIR = 0x40000000
+# directory moves and deletes are only subscribed to invalidate the path cache
+FAN_MASK = _FAN_CLOSE_WRITE | _FAN_MOVED_TO | _FAN_MOVED_FROM | _FAN_DELETE | _FAN_ONDIR
+_FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+_AT_FDCWD = -100
+_MAX_HANDLE_SZ = 128
+_FAN_DIR_CACHE_MAX = 4096
+_MOUNTINFO_ESCAPE = re.compile(rb"\\([0-7]{3})")
+# struct fanotify_event_metadata: event_len, vers, reserved, metadata_len, mask, fd, pid
+FAN_EVENT_HEADER = struct.Struct("IBBHQii")
+# struct fanotify_event_info_header: info_type, pad, len, then an 8 bytes fsid
+FAN_INFO_HEADER = struct.Struct("BBH8x")
+# struct file_handle without f_handle: handle_bytes, handle_type
+FAN_HANDLE_HEADER = struct.Struct("Ii")
+
+
+def _coalesce(events: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """Keep the first of repeated file events, directory events all in order.
+
+    e.g. editors saving in several steps, or CLOSE_WRITE and MOVED_TO of the
+    same file, are handled once. A directory removed and created again must
+    end up watched, so its mkdir and rmdir are never merged.
+    """
+    seen = set()
+    coalesced = []
+    for event in events:
+        if event[0] == "file":
+            if event in seen:
+                continue
+            seen.add(event)
+        coalesced.append(event)
+    return coalesced
+
+
+def _unescape_mount(field: bytes) -> str:
+    """Mountinfo fields have spaces and such octal escaped, e.g. \\040."""
+    return os.fsdecode(
+        _MOUNTINFO_ESCAPE.sub(lambda match: bytes([int(match[1], 8)]), field)
+    )
+
+
+def _mounts_below(root: str) -> list[str]:
+    """Outermost mount points strictly below root, from /proc/self/mountinfo."""
+    prefix = root.rstrip("/") + "/"
+    with open("/proc/self/mountinfo", "rb") as mountinfo:
+        # the 5th field is the mount point
+        points = sorted({_unescape_mount(line.split()[4]) for line in mountinfo})
+    mounts = []
+    for point in points:
+        if point == root or not point.startswith(prefix):
+            continue
+        if mounts and point.startswith(mounts[-1] + "/"):
+            continue  # scanning the outer mount watches this one too
+        mounts.append(point)
+    return mounts
+
+
+def _errno_error() -> OSError:
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+class _Fanotify:
+    """Report closed and moved in files under root as (status, path str).
+
+    The mark is on the whole filesystem, so events outside root are dropped.
+    Other filesystems mounted below root are not covered, FileWatcher watches
+    the ones mounted at start with inotify.
+    """
+
+    def __init__(self, root: str):
+        self.fd = _libc.fanotify_init(FAN_INIT_FLAGS, os.O_RDONLY | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise _errno_error()
+        self.root = root
+        self._prefix = root.rstrip("/") + "/"
+        self._mount_fd = -1
+        self._dirs: dict[bytes, str] = {}
+        self._buf = bytearray(READ_BUFFER_SIZE)
+        try:
+            self._mount_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            # event paths come from open_by_handle_at, which needs
+            # CAP_DAC_READ_SEARCH, check it works before relying on it
+            if self._resolve(self._name_to_handle(root)) is None:
+                raise _errno_error()
+            marked = _libc.fanotify_mark(
+                self.fd, FAN_MARK_FLAGS, FAN_MASK, _AT_FDCWD, os.fsencode(root)
+            )
+            if marked < 0:
+                raise _errno_error()
+        except OSError:
+            self.close()
+            raise
+
+    def covers(self, directory: str) -> bool:
+        return directory == self.root or directory.startswith(self._prefix)
+
+    def _name_to_handle(self, path: str) -> bytes:
+        raw = ctypes.create_string_buffer(FAN_HANDLE_HEADER.size + _MAX_HANDLE_SZ)
+        FAN_HANDLE_HEADER.pack_into(raw, 0, _MAX_HANDLE_SZ, 0)
+        mount_id = ctypes.c_int()
+        found = _libc.name_to_handle_at(
+            _AT_FDCWD, os.fsencode(path), raw, ctypes.byref(mount_id), 0
+        )
+        if found < 0:
+            raise _errno_error()
+        handle_bytes, _ = FAN_HANDLE_HEADER.unpack_from(raw)
+        return raw.raw[: FAN_HANDLE_HEADER.size + handle_bytes]
+
+    def _resolve(self, handle: bytes) -> str:
+        """Path of the directory behind a file handle, None if it is gone."""
+        fd = _libc.open_by_handle_at(self._mount_fd, handle, os.O_PATH | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        try:
+            directory = os.readlink(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+        if len(self._dirs) >= _FAN_DIR_CACHE_MAX:
+            self._dirs.clear()
+        self._dirs[handle] = directory
+        return directory
+
+    def _forget(self, directory: str):
+        """Drop the cached paths of directory and the directories below it."""
+        prefix = directory + "/"
+        stale = [
+            handle
+            for handle, path in self._dirs.items()
+            if path == directory or path.startswith(prefix)
+        ]
+        for handle in stale:
+            del self._dirs[handle]
+
+    def drain(self, out: list[tuple[str, str]]):
+        """Append every pending event to out until the fd is empty."""
+        append = out.append
+        fd = self.fd
+        buf = self._buf
+        bufs = [buf]
+        unpack_event = FAN_EVENT_HEADER.unpack_from
+        unpack_info = FAN_INFO_HEADER.unpack_from
+        info_size = FAN_INFO_HEADER.size
+        unpack_handle = FAN_HANDLE_HEADER.unpack_from
+        handle_size = FAN_HANDLE_HEADER.size
+        dirs = self._dirs
+        covers = self.covers
+        decode_name = _decode_name
+
+        while True:
+            try:
+                size = os.readv(fd, bufs)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < size:
+                event_len, _, _, metadata_len, mask, _, _ = unpack_event(buf, offset)
+                info = offset + metadata_len
+                offset += event_len
+
+                if mask & _FAN_Q_OVERFLOW:
+                    # the queue is shared with the whole filesystem, busy
+                    # directories elsewhere can overflow it too
+                    _log.warning("fanotify queue overflowed, events were lost")
+                    continue
+                if not mask & (_FAN_ONDIR | _FAN_CLOSE_WRITE | _FAN_MOVED_TO):
+                    continue  # file moved out or deleted
+
+                while info < offset:
+                    info_type, _, info_len = unpack_info(buf, info)
+                    if info_type == _FAN_EVENT_INFO_TYPE_DFID_NAME:
+                        break
+                    info += info_len
+                else:
+                    continue
+
+                handle_start = info + info_size
+                handle_bytes, _ = unpack_handle(buf, handle_start)
+                name_start = handle_start + handle_size + handle_bytes
+                handle = bytes(buf[handle_start:name_start])
+                directory = dirs.get(handle) or self._resolve(handle)
+                if directory is None:
+                    if mask & _FAN_ONDIR:
+                        dirs.clear()  # cannot tell which cached paths are stale
+                    continue
+                ondir = mask & _FAN_ONDIR
+                if not ondir and not covers(directory):
+                    continue
+
+                end = buf.index(0, name_start, info + info_len)
+                name = decode_name(bytes(buf[name_start:end]))
+                if ondir:
+                    # a directory moved or gone, the cached paths at and below it
+                    # are stale, wherever it is
+                    self._forget(f"{directory}/{name}")
+                else:
+                    append(("file", f"{directory}/{name}"))
+
+    def close(self):
+        if self._mount_fd >= 0:
+            os.close(self._mount_fd)
+            self._mount_fd = -1
+        os.close(self.fd)
 
 
 class FileWatcher:
     def __init__(self):
-        self.inotify = INotify()
-        self.watch_dir = {}
+        self.inotify = INotify(nonblocking=True)
+        self.dir_to_wd: dict[pathlib.Path, int] = {}
+        self.wd_to_dirstr: dict[int, str] = {}
+        self._buf = bytearray(READ_BUFFER_SIZE)
+        self._fanotify: _Fanotify = None
+        self.stopped = False
+        # epoll over inotify and an eventfd, so stop() wakes up any waiter
+        self._epoll = select.epoll()
+        self._epoll.register(self.inotify.fileno(), INOTIFY_EPOLL_MASK)
+        self._wake = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self._epoll.register(self._wake, select.EPOLLIN)
+
+    def fileno(self) -> int:
+        """The epoll fd, readable when wait() would not block."""
+        return self._epoll.fileno()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait up to timeout seconds, True if inotify events can be drained."""
+        readable = False
+        for fd, _ in self._epoll.poll(-1 if timeout is None else timeout):
+            if fd == self._wake:
+                os.eventfd_read(self._wake)
+                self.stopped = True
+            else:
+                readable = True
+        return readable
+
+    def stop(self):
+        """Make waiters return with stopped set, safe to call from any thread."""
+        os.eventfd_write(self._wake, 1)
 
     def add_watch(self, directory: pathlib.Path, rec_flag: bool = False):
         watch = self.inotify.add_watch(directory, MASK_REC if rec_flag else MASK_DIR)
-        self.watch_dir[watch] = directory
-        self.watch_dir[directory] = watch
+        self.dir_to_wd[directory] = watch
+        self.wd_to_dirstr[watch] = os.fspath(directory)
 
-    def rec_add_watch(self, directory: pathlib.Path):
-        self.add_watch(directory, rec_flag=True)
+    def _add_fanotify(self, directory: pathlib.Path) -> bool:
+        """Cover directory with fanotify if it can be used, instead of inotify."""
+        root = str(directory)
+        if self._fanotify is not None:
+            return self._fanotify.covers(root)
+        if not HAS_FANOTIFY:
+            _log.warning("fanotify is not available, watch %s with inotify", root)
+            return False
+        try:
+            self._fanotify = _Fanotify(root)
+        except OSError as err:
+            # EPERM unprivileged, EINVAL before 5.9, ENODEV/EOPNOTSUPP/EXDEV if
+            # the filesystem cannot report file handles
+            _log.warning("cannot use fanotify (%s), watch %s with inotify", err, root)
+            return False
+        self._epoll.register(self._fanotify.fd, INOTIFY_EPOLL_MASK)
+        return True
 
-        for watch in filter(lambda x: x.is_dir(), directory.rglob("*")):
-            self.add_watch(watch, rec_flag=True)
+    def rec_add_watch(self, directory: pathlib.Path, fanotify: bool = False):
+        """Watch the tree of directory, with a single fanotify mark if asked.
+
+        The mark reports every file closed or moved on the whole filesystem to
+        this process, so it is opt-in.
+        """
+        if not (fanotify and self._add_fanotify(directory)):
+            self._scan_add_watch(str(directory))
+            watches = len(self.dir_to_wd)
+            _log.info("watch %s with %d inotify watches", directory, watches)
+            return
+        # the mark covers the filesystem of directory only, so other mounts
+        # below it still need inotify watches
+        mounts = _mounts_below(str(directory))
+        for mount in mounts:
+            self._scan_add_watch(mount)
+        _log.info(
+            "watch %s with a fanotify mark, %d mounts below it with inotify",
+            directory,
+            len(mounts),
+        )
+
+    def _scan_add_watch(self, top: str):
+        # DirEntry.is_dir uses d_type from readdir, so files are never stat'ed.
+        # A directory is watched before it is scanned, subdirectories created
+        # meanwhile are reported as mkdir and ones removed meanwhile are skipped.
+        # add_watch is inlined here, this loop runs once per directory in the tree.
+        add, mask, to_path = self.inotify.add_watch, MASK_REC, pathlib.Path
+        dir_to_wd, wd_to_dirstr = self.dir_to_wd, self.wd_to_dirstr
+        stack = [top]
+        while stack:
+            current = stack.pop()
+            try:
+                watch = add(current, mask)
+                dir_to_wd[to_path(current)] = watch
+                wd_to_dirstr[watch] = current
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
 
     def remove_watch(self, directory: pathlib.Path):
-        del self.watch_dir[self.watch_dir[directory]]
-        del self.watch_dir[directory]
-
-    def read(self):
-        for watch, mask, _, name in self.inotify.read():
-            masks = flags.from_mask(mask)
-            pathname = self.watch_dir[watch] / name
-            status = None
-
-            if flags.ISDIR in masks:
-                if flags.CREATE in masks or flags.MOVED_TO in masks:
-                    status = "mkdir"
+        # already forgotten if its IN_IGNORED was drained first
+        watch = self.dir_to_wd.pop(directory, None)
+        if watch is not None:
+            del self.wd_to_dirstr[watch]
+
+    def rewatch(self, directories: set[pathlib.Path], rec_flag: bool = False):
+        """Watch exactly directories, keeping the watches already in place."""
+        for directory in self.dir_to_wd.keys() - directories:
+            try:
+                self.inotify.rm_watch(self.dir_to_wd[directory])
+            except OSError:
+                pass  # the kernel already dropped it, e.g. directory removed
+            self.remove_watch(directory)
+        for directory in directories - self.dir_to_wd.keys():
+            self.add_watch(directory, rec_flag)
+
+    def drain(self) -> list[tuple[str, str]]:
+        """Read every pending event until the fd is empty, as (status, path str)."""
+        out = []
+        append = out.append
+        fd = self.inotify.fileno()
+        buf = self._buf
+        bufs = [buf]
+        unpack_from = EVENT_HEADER.unpack_from
+        header_size = EVENT_HEADER.size
+        wd_to_dirstr = self.wd_to_dirstr
+        dir_to_wd = self.dir_to_wd
+        decode_name = _decode_name
+
+        while True:
+            try:
+                size = os.readv(fd, bufs)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < size:
+                watch, mask, _, namesize = unpack_from(buf, offset)
+                offset += header_size
+                if namesize:
+                    # name is NUL padded to namesize, stop at the first NUL
+                    end = buf.index(0, offset, offset + namesize)
+                    name = decode_name(bytes(buf[offset:end]))
                 else:
-                    status = "rmdir"
+                    name = ""
+                offset += namesize
 
-            elif flags.CLOSE_WRITE in masks or flags.MOVED_TO in masks:
-                status = "file"
+                directory = wd_to_dirstr.get(watch)
+                if directory is None:
+                    if mask & _Q_OVERFLOW:
+                        _log.warning("inotify queue overflowed, events were lost")
+                    # else IN_IGNORED of a removed watch
+                    continue
+                if mask & _IGNORED:
+                    # the kernel dropped the watch as its directory went away,
+                    # forget it so add_watch or rewatch watch the path again
+                    del wd_to_dirstr[watch]
+                    path = pathlib.Path(directory)
+                    if dir_to_wd.get(path) == watch:
+                        del dir_to_wd[path]
+                    continue
 
-            yield status, pathname
+                if mask & _ISDIR:
+                    status = "mkdir" if mask & (_CREATE | _MOVED_TO) else "rmdir"
+                elif mask & (_CLOSE_WRITE | _MOVED_TO):
+                    status = "file"
+                else:
+                    # CREATE before the CLOSE_WRITE of a file, or it went away
+                    continue
+
+                # consumers wrap the path only if they need a Path object
+                append((status, f"{directory}/{name}" if name else directory))
+
+        if self._fanotify is not None:
+            self._fanotify.drain(out)
+        return _coalesce(out)
 
     def reset(self):
+        self._epoll.unregister(self.inotify.fileno())
+        self.inotify.close()
+        self.dir_to_wd.clear()
+        self.wd_to_dirstr.clear()
+        self.inotify = INotify(nonblocking=True)
+        self._epoll.register(self.inotify.fileno(), INOTIFY_EPOLL_MASK)
+        if self._fanotify is not None:
+            self._epoll.unregister(self._fanotify.fd)
+            self._fanotify.close()
+            self._fanotify = None
+
+    def close(self):
+        self._epoll.close()
+        os.close(self._wake)
         self.inotify.close()
-        self.watch_dir.clear()
-        self.inotify = INotify()
+        if self._fanotify is not None:
+            self._fanotify.close()
@@ -6,14 +6,17 @@ Filename: log
 Author: CJ Lin
 """
 
+import atexit
 import logging
 import logging.handlers
+import os
 import pathlib
+import queue
 
 
 def get_logger(prefix: pathlib.Path, is_debug: bool) -> logging.Logger:
     if prefix:
-        prefix.parent.mkdir(parents=True, exist_ok=True)
+        os.makedirs(prefix.parent, exist_ok=True)
         handler = logging.handlers.TimedRotatingFileHandler(prefix, when="midnight")
         handler.suffix = "%Y%m%d"
     else:
@@ -21,7 +24,23 @@ def get_logger(prefix: pathlib.Path, is_debug: bool) -> logging.Logger:
 
     log = logging.getLogger()
     log.setLevel(logging.DEBUG if is_debug else logging.INFO)
-    handler.setFormatter(logging.Formatter("%(asctime)s\n%(message)s\n"))
-    log.addHandler(handler)
+    formatter = logging.Formatter("%(asctime)s\n%(message)s\n")
+    formatter.default_msec_format = None
+    handler.setFormatter(formatter)
+
+    # Records only render asctime and message, skip collecting the rest.
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging._srcfile = None
+
+    # Only enqueue on the caller, the listener thread formats and writes records.
+    log_queue = queue.SimpleQueue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
 
     return log
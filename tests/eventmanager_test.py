@@ -1,21 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import dataclasses
+import datetime
 import os
 import pathlib
+import shutil
 import subprocess
 import time
 
 import pytest
+import yaml
+
+from event_manager import cron, event_manager, file_watch
+
+CONF = pathlib.Path(__file__).parent / "event-manager.yml"
+# minute hour day month weekday, crule takes no "*" so every value is listed
+EVERY_MINUTE = " ".join(
+    ",".join(map(str, values))
+    for values in (range(60), range(24), range(1, 32), range(1, 13), range(7))
+)
 
 
 @dataclasses.dataclass
 class AllItem:
     root: pathlib.Path
+    conf: pathlib.Path
+    flags: str = "-rav"
     data: pathlib.Path = None
     backup: pathlib.Path = None
-    conf: pathlib.Path = pathlib.Path(__file__).parent / "event-manager.yml"
     proc: subprocess.Popen = None
 
     def __post_init__(self):
@@ -30,43 +44,265 @@ class AllItem:
         os.environ["TMPBACKUP"] = str(self.backup)
 
         self.proc = subprocess.Popen(
-            f"event-manager start -d {self.root} -f {self.conf} -rav",
-            shell=True,
+            ["event-manager", "start", "-d", self.root, "-f", self.conf, self.flags]
         )
-        time.sleep(1)
+
+        # The sentinel is backed up once the watcher is live, see event "ready".
+        sentinel = self.data / ".ready"
+        if not wait_exists(self.backup / ".ready", timeout=5, rewrite=sentinel):
+            raise RuntimeError("event-manager did not start")
+        sentinel.unlink()
+        (self.backup / ".ready").unlink(missing_ok=True)
 
     def close(self):
         self.proc.terminate()
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def wait_exists(path, timeout=2.0, rewrite=None):
+    """Poll until path exists, rewriting the rewrite file to generate events."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if path.exists():
+            return True
+        if rewrite:
+            rewrite.write_bytes(b"")
+        time.sleep(0.02)
+    return False
 
 
-@pytest.fixture()
-def create_eventmanager(tmp_path):
-    item = AllItem(root=tmp_path)
+@pytest.fixture(scope="module")
+def create_eventmanager(tmp_path_factory):
+    # Shared by the tests below, each of them triggers its own event of the config.
+    conf = tmp_path_factory.mktemp("conf") / CONF.name
+    shutil.copyfile(CONF, conf)
+    item = AllItem(root=tmp_path_factory.mktemp("eventmanager"), conf=conf)
     yield item
     item.close()
 
 
+@pytest.fixture
+def make_manager(tmp_path):
+    # Not started, only its config is loaded to test how triggers match.
+    managers = []
+
+    def make(events):
+        (tmp_path / "data" / "sub").mkdir(parents=True, exist_ok=True)
+        conf = tmp_path / "conf.yml"
+        conf.write_text(yaml.safe_dump({"Events": events}, sort_keys=False))
+        managers.append(
+            event_manager.EventManager(
+                event_manager.GeneralConfig(watch=str(tmp_path), conf=str(conf))
+            )
+        )
+        return managers[-1]
+
+    yield make
+    for manager in managers:
+        manager.filewatcher.close()
+
+
+def matched_events(manager, pathname):
+    return [trigger.event for trigger, _ in manager.match_triggers(str(pathname))]
+
+
 def test_relative_path(create_eventmanager):
     (create_eventmanager.data / "test1").touch()
-    time.sleep(1)
-    assert (create_eventmanager.backup / "test1").exists()
+    assert wait_exists(create_eventmanager.backup / "test1")
 
 
 def test_environment_variables(create_eventmanager):
     (create_eventmanager.data / "test2").touch()
-    time.sleep(1)
-    assert (create_eventmanager.backup / "test2").exists()
+    assert wait_exists(create_eventmanager.backup / "test2")
 
 
 def test_create_directories(create_eventmanager):
-    (create_eventmanager.data / "test3").mkdir()
-    time.sleep(1)
-    (create_eventmanager.data / "test3" / "test3").touch()
-    time.sleep(1)
-    assert (create_eventmanager.backup / "test3" / "test3").exists()
+    target = create_eventmanager.data / "test3" / "test3"
+    target.parent.mkdir(parents=True)
+    target.touch()
+    # the new directory is watched only after its mkdir event is handled
+    assert wait_exists(create_eventmanager.backup / "test3" / "test3", rewrite=target)
+
+
+def test_match_triggers_config_order(make_manager, tmp_path):
+    manager = make_manager(
+        {
+            "wild": {"File": "(data|other)/sub/f.*", "Process": "true"},
+            "ancestor": {"File": "data/.*", "Process": "true"},
+            "parent": {"File": "data/sub/f.*", "Process": "true"},
+        }
+    )
+    root = tmp_path.resolve()
+    # "ancestor" is found by walking up from data/sub to data
+    assert matched_events(manager, root / "data" / "sub" / "file") == [
+        "wild",
+        "ancestor",
+        "parent",
+    ]
+    assert matched_events(manager, root / "data" / "sub" / "other") == ["ancestor"]
+
+
+def test_match_triggers_combined(make_manager, tmp_path):
+    manager = make_manager(
+        {
+            "prefix": {"File": "data/(?P<head>x.*)", "Process": "true"},
+            "suffix": {"File": "data/(?P<tail>.*y)", "Process": "true"},
+            "exact": {"File": "data/z", "Process": "true"},
+        }
+    )
+    data = tmp_path.resolve() / "data"
+    assert manager._bucket_regex[str(data)] is not None
+    # the combined pattern finds the first, the later ones are tried one by one
+    assert matched_events(manager, data / "xy") == ["prefix", "suffix"]
+    assert matched_events(manager, data / "ay") == ["suffix"]
+    assert matched_events(manager, data / "z") == ["exact"]
+    assert matched_events(manager, data / "none") == []
+
+
+def test_directory_recreated_in_one_batch(tmp_path, monkeypatch):
+    # fanotify reports no directory events, test the inotify scan
+    monkeypatch.setattr(file_watch, "HAS_FANOTIFY", False)
+    watcher = file_watch.FileWatcher()
+    try:
+        watcher.rec_add_watch(tmp_path)
+        target = tmp_path / "recreated"
+        target.mkdir()
+        target.rmdir()
+        target.mkdir()
+        assert watcher.wait(1)
+        events = watcher.drain()
+        assert [status for status, _ in events] == ["mkdir", "rmdir", "mkdir"]
+
+        # as EventManager does, the directory stays watched
+        for status, pathname in events:
+            if status == "mkdir":
+                watcher.add_watch(pathlib.Path(pathname), rec_flag=True)
+            else:
+                watcher.remove_watch(pathlib.Path(pathname))
+        (target / "inner").write_bytes(b"")
+        assert watcher.wait(1)
+        assert watcher.drain() == [("file", str(target / "inner"))]
+    finally:
+        watcher.close()
+
+
+def test_rewatch_recreated_directory(tmp_path):
+    watcher = file_watch.FileWatcher()
+    try:
+        target = tmp_path / "recreated"
+        target.mkdir()
+        watcher.rewatch({target})
+        target.rmdir()
+        target.mkdir()
+        # the reader drains the IN_IGNORED of the dropped watch before a reload
+        assert watcher.wait(1)
+        assert watcher.drain() == []
+
+        watcher.rewatch({target})
+        (target / "inner").write_bytes(b"")
+        assert watcher.wait(1)
+        assert watcher.drain() == [("file", str(target / "inner"))]
+    finally:
+        watcher.close()
+
+
+def test_fanotify(tmp_path):
+    tmp_path = tmp_path.resolve()
+    root = tmp_path / "root"
+    (root / "cached").mkdir(parents=True)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    try:
+        fanotify = file_watch._Fanotify(str(root))
+    except PermissionError:
+        pytest.skip("fanotify needs CAP_SYS_ADMIN")
+    try:
+        (root / "new").mkdir()
+        (root / "new" / "created").write_bytes(b"")
+        (outside / "moved").write_bytes(b"")
+        (outside / "moved").rename(root / "moved")
+        (root / "cached" / "first").write_bytes(b"")
+        events = []
+        fanotify.drain(events)
+        assert events == [
+            ("file", str(root / "new" / "created")),
+            ("file", str(root / "moved")),
+            ("file", str(root / "cached" / "first")),
+        ]
+
+        # the cached path of the renamed directory is dropped, others are kept
+        (root / "cached").rename(root / "renamed")
+        (root / "renamed" / "second").write_bytes(b"")
+        events = []
+        fanotify.drain(events)
+        assert events == [("file", str(root / "renamed" / "second"))]
+        assert str(root) in fanotify._dirs.values()
+    finally:
+        fanotify.close()
+
+
+def test_backup_onto_source(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"data")
+    (tmp_path / "link").symlink_to(source)
+    with pytest.raises(shutil.SameFileError):
+        event_manager._fast_copy(str(source), tmp_path / "link")
+    assert source.read_bytes() == b"data"
+
+
+def test_cron_next_time():
+    rule = cron.crule(EVERY_MINUTE)
+    times = [rule.get_next_time() for _ in range(5)]
+    assert times[0] > datetime.datetime.now()
+    # strictly increasing, so no time is ever returned twice
+    assert all(early < late for early, late in zip(times, times[1:]))
+
+
+def test_cron_generate():
+    crontab = cron.crontab()
+    at = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+    crontab.rules[at].append((cron.crule(EVERY_MINUTE), "soon"))
+
+    async def first():
+        return await asyncio.wait_for(anext(crontab.generate()), timeout=2)
+
+    assert asyncio.run(first()) == (at, "soon")
+    assert datetime.datetime.now() >= at
+
+
+REFRESH_CONF = """\
+Events:
+  ready:
+    File: data/(?P<ready>\\.ready)
+    Process: echo $file
+    Backup: backup/$ready
+  {name}:
+    File: {name}/(?P<test>test4)
+    Process: echo $file
+    Backup: backup/{name}-$test
+"""
+
 
+def test_refresh(tmp_path):
+    # Not recursive, the watched directories follow the triggers of the config.
+    conf = tmp_path / "conf.yml"
+    conf.write_text(REFRESH_CONF.format(name="old"))
+    root = tmp_path / "root"
+    for name in ("old", "new"):
+        (root / name).mkdir(parents=True)
+    item = AllItem(root=root, conf=conf, flags="-av")
+    try:
+        assert wait_exists(item.backup / "old-test4", rewrite=root / "old" / "test4")
 
-def test_refresh(create_eventmanager):
-    create_eventmanager.conf.touch()
-    time.sleep(1)
-    assert create_eventmanager.proc.poll() is None
+        conf.write_text(REFRESH_CONF.format(name="new"))
+        assert wait_exists(item.backup / "new-test4", rewrite=root / "new" / "test4")
+        (item.backup / "old-test4").unlink()
+        (root / "old" / "test4").write_bytes(b"")
+        assert not wait_exists(item.backup / "old-test4", timeout=0.5)
+        assert item.proc.poll() is None
+    finally:
+        item.close()